@@ -0,0 +1,33 @@
+"""
+Compile the PyWham iteration kernel of wham.py ahead-of-time into the
+wham_ext extension module, so that it does not have to be compiled by numba
+the first time it is used
+
+The extension does not need numba at runtime and is used by wham.py when numba
+is not installed, if it is on the PYTHONPATH. By default it is put in the same
+folder as wham.py. It runs serially, so with numba installed the parallel
+jitted kernel is used instead
+
+Requires numba
+"""
+
+import argparse
+import os
+
+from numba.pycc import CC
+
+import wham
+
+if __name__ == '__main__' :
+
+  # Command-line input
+
+  parser = argparse.ArgumentParser(description="Compile the WHAM iteration kernel ahead-of-time")
+  parser.add_argument('-o','--outdir',help="the folder to put the extension module in",default=os.path.dirname(os.path.abspath(wham.__file__)))
+  args = parser.parse_args()
+
+  cc = CC("wham_ext")
+  cc.output_dir = args.outdir
+  cc.export("oneiter",wham.WHAM_ONEITER_SIGNATURES["f8"])(wham._wham_oneiter_impl)
+  cc.export("oneiter_f4",wham.WHAM_ONEITER_SIGNATURES["f4"])(wham._wham_oneiter_impl)
+  cc.compile()
@@ -6,14 +6,19 @@ execute weighted histogram analysis method (WHAM) and calculate
 the PMF along a 1D reaction coordinate
 """
 
+import logging
+import math
 import os
 import tempfile
 import shutil
 import subprocess
 
 import numpy as np
-import numpy.random as random
-import matplotlib.pylab as plt
+try :
+  from numba import njit, prange
+  HAS_NUMBA = True
+except ImportError :
+  HAS_NUMBA = False
 
 KJMOL = 1
 KCALMOL = 2
@@ -22,6 +27,14 @@ ECONV = {KJMOL : {KJMOL : 1.0, KCALMOL : 1.0/4.184}, KCALMOL : {KJMOL : 4.184, K
 ELABEL = {KJMOL : "kJ/mol", KCALMOL : "kcal/mol"}
 LABEL2UNIT = {"kJ/mol" : KJMOL, "kcal/mol" : KCALMOL}
 
+logger = logging.getLogger(__name__)
+
+# np.trapz is deprecated in favour of np.trapezoid since numpy 2.0
+_trapezoid = getattr(np,"trapezoid",None) or np.trapz
+
+# Result files larger than this are parsed memory-mapped with pandas, if available
+MMAP_SIZE = 1024**3
+
 #####################
 # Histogram routines
 #####################
@@ -45,22 +58,153 @@ def make_bins(data,nbins,boundaries=None) :
   numpy array
     the bins edges
   """
-  def get_99_conf(data) :
-    mean = data.mean()
-    std  = data.std()
-    return (mean-2.58*std,mean+2.58*std)
-
-  if boundaries == None :
-    mn,ma = get_99_conf(data[0])
-    for d in  data[1:] :
-      lo,hi = get_99_conf(d)
-      mn = min(mn,lo)
-      ma = max(ma,hi)
+  if boundaries is None :
+    mns = np.fromiter((d.mean() for d in data),dtype=np.float64,count=len(data))
+    sts = np.fromiter((d.std() for d in data),dtype=np.float64,count=len(data))
+    mn = (mns-2.58*sts).min()
+    ma = (mns+2.58*sts).max()
   else :
     mn,ma = boundaries
 
   return np.linspace(mn,ma,nbins+1,endpoint=True)
 
+def _uniform_bin_hist(data,bins,weights=None) :
+  """
+  Histogram set of data on equally spaced edges
+
+  Gives the same result as np.histogram on each data set, but computes the
+  bin index directly rather than searching the edges, and counts all data sets
+  in a single pass
+
+  Parameters
+  ----------
+  data : list of numpy array
+    the data to be histogrammed
+  bins : numpy array
+    the equally spaced edges of the histogram
+  weights : numpy array, optional
+    the weight of the data, concatenated over all data sets
+
+  Returns
+  -------
+  numpy array
+    the histogram of each data set, one row per set
+  """
+  bins = np.asarray(bins,dtype=np.float64)
+  nbins = len(bins)-1
+  lens = np.fromiter((d.shape[0] for d in data),dtype=np.intp,count=len(data))
+  flat = np.concatenate(data)
+  inside = (flat >= bins[0]) & (flat <= bins[-1])
+  x = flat[inside]
+  idx = ((x-bins[0])*(nbins/(bins[-1]-bins[0]))).astype(np.intp)
+  # The last edge is inclusive, as in np.histogram
+  np.minimum(idx,nbins-1,out=idx)
+  # The computed index can be off by one due to rounding, correct it
+  # against the edges as np.histogram does
+  idx[x < bins[idx]] -= 1
+  idx += (x >= bins[idx+1]) & (idx != nbins-1)
+  # Offset the bin index of each data set so that they do not overlap
+  idx += np.repeat(np.arange(len(data))*nbins,lens)[inside]
+  if weights is not None : weights = weights[inside]
+  hist = np.bincount(idx,weights=weights,minlength=len(data)*nbins)
+  return hist.reshape(len(data),nbins)
+
+if HAS_NUMBA :
+  @njit(cache=True)
+  def _edge_bin(x,bins,scale,nbins) :
+    """
+    The bin of a sample lying between the first and last of the equally
+    spaced edges, computed directly and corrected against the edges
+    """
+    b = min(int((x-bins[0])*scale),nbins-1)
+    if x < bins[b] :
+      b -= 1
+    elif b < nbins-1 and x >= bins[b+1] :
+      b += 1
+    return b
+
+  @njit(parallel=True,cache=True)
+  def _wham_hist_weighted(flat,energies,kT,bins,offsets,out) :
+    """
+    Boltzmann weight and histogram concatenated data sets in one pass,
+    each data set is binned by its own thread into its row of out
+    """
+    nbins = bins.shape[0]-1
+    scale = nbins/(bins[nbins]-bins[0])
+    for w in prange(offsets.shape[0]-1) :
+      for j in range(offsets[w],offsets[w+1]) :
+        x = flat[j]
+        # Written so that NaN samples are skipped
+        if not (x >= bins[0] and x <= bins[nbins]) : continue
+        out[w,_edge_bin(x,bins,scale,nbins)] += math.exp(-energies[j]/kT)
+
+  @njit(parallel=True,cache=True)
+  def _wham_hist(flat,bins,offsets,out) :
+    """
+    Histogram concatenated data sets in one pass,
+    each data set is binned by its own thread into its row of out
+    """
+    nbins = bins.shape[0]-1
+    scale = nbins/(bins[nbins]-bins[0])
+    for w in prange(offsets.shape[0]-1) :
+      for j in range(offsets[w],offsets[w+1]) :
+        x = flat[j]
+        # Written so that NaN samples are skipped
+        if not (x >= bins[0] and x <= bins[nbins]) : continue
+        out[w,_edge_bin(x,bins,scale,nbins)] += 1
+
+def _uniform_edges(bins) :
+  """
+  Whether the histogram edges are equally spaced
+  """
+  return np.allclose(np.diff(bins),bins[1]-bins[0])
+
+def _window_offsets(data) :
+  """
+  The start of each data set in the concatenated data, followed by the total length
+  """
+  offsets = np.zeros(len(data)+1,dtype=np.intp)
+  np.cumsum([d.shape[0] for d in data],out=offsets[1:])
+  return offsets
+
+def _boltzmann_hist(data,energies,kT,bins) :
+  """
+  Histogram set of data, weighting each sample with
+  the Boltzmann factor of its total energy
+
+  Uses a compiled kernel if numba is available, raises ValueError
+  if the energies of a data set are not as many as its samples
+
+  Parameters
+  ----------
+  data : list of numpy array
+    the data to be histogrammed
+  energies : list of numpy array
+    the total energy of each sample
+  kT : float
+    the temperature factor
+  bins : numpy array
+    the edges of the histogram
+
+  Returns
+  -------
+  numpy array
+    the histogram of the data, one row per data set
+  """
+  if len(energies) != len(data) or any(e.shape[0] != d.shape[0] for d,e in zip(data,energies)) :
+    raise ValueError("The energies do not match the samples")
+  if not _uniform_edges(bins) :
+    return make_reweighted_histograms(data,[np.exp(-e/kT) for e in energies],bins)[0]
+
+  if HAS_NUMBA :
+    bins = np.asarray(bins,dtype=np.float64)
+    hist = np.zeros((len(data),len(bins)-1))
+    _wham_hist_weighted(np.concatenate(data),np.concatenate(energies),kT,bins,_window_offsets(data),hist)
+    return hist
+  weights = np.concatenate(energies)
+  weights *= -1.0/kT
+  np.exp(weights,out=weights)
+  return _uniform_bin_hist(data,bins,weights=weights)
 
 def make_histograms(data,bins,boundaries=None) :
   """
@@ -68,26 +212,36 @@ def make_histograms(data,bins,boundaries=None) :
 
   Mainly used by UmbrellaSim class, but could be useful in other circumstances
 
+  Uses a compiled kernel if numba is available
+
   Parameters
   ----------
   data : numpy array
     the data to be histogrammed
   bins : int or numpy array
-    the number of bins to use or the edges of the histogram
+    the number of bins to use or the edges of the histogram,
+    edges that are not equally spaced are binned with np.histogram
   boundaries : list of float, optional
     the minimum and maximum of the edges
 
   Returns
   -------
-  list of numpy array
-    the histogram of the data
+  numpy array
+    the histogram of the data, one row per data set
   numpy array
     the bin edges
   """
   if not np.iterable(bins) :
     bins = make_bins(data,bins,boundaries)
 
-  histograms = [np.histogram(d,bins)[0] for d in data]
+  if not _uniform_edges(bins) :
+    return np.array([np.histogram(d,bins)[0] for d in data]),bins
+
+  if HAS_NUMBA :
+    histograms = np.zeros((len(data),len(bins)-1),dtype=np.intp)
+    _wham_hist(np.concatenate(data),np.asarray(bins,dtype=np.float64),_window_offsets(data),histograms)
+  else :
+    histograms = _uniform_bin_hist(data,bins)
   return histograms,bins
 
 def make_reweighted_histograms(data,weights,bins,boundaries=None) :
@@ -103,27 +257,90 @@ def make_reweighted_histograms(data,weights,bins,boundaries=None) :
   weights : numpy array
     the weight of the data
   bins : int or numpy array
-    the number of bins to use or the edges of the histogram
+    the number of bins to use or the edges of the histogram,
+    edges that are not equally spaced are binned with np.histogram
   boundaries : list of float, optional
     the minimum and maximum of the edges
 
   Returns
   -------
-  list of numpy array
-    the histogram of the data
+  numpy array
+    the histogram of the data, one row per data set
   numpy array
     the bin edges
   """
   if not np.iterable(bins) :
     bins = make_bins(data,bins,boundaries)
 
-  histograms = [np.histogram(d,bins,weights=w)[0] for d,w in zip(data,weights)]
+  if not _uniform_edges(bins) :
+    return np.array([np.histogram(d,bins,weights=w)[0] for d,w in zip(data,weights)]),bins
+
+  histograms = _uniform_bin_hist(data,bins,weights=np.concatenate(weights))
   return histograms,bins
 
 #######################################################################
 # Classes to read and analyse results from umbrella/zconst simulations
 #######################################################################
 
+def _parse_column(filename,colidx,comments=("#",)) :
+  """
+  Parse a single column of floats from a whitespace-separated file
+
+  Lines starting with any of the comment characters are ignored, as are
+  lines that lack the column or cannot be converted to a float
+
+  Files larger than MMAP_SIZE are memory-mapped and parsed with pandas,
+  if it is available
+
+  Parameters
+  ----------
+  filename : string
+    the name of the file
+  colidx : int
+    the index of the column to parse
+  comments : tuple of string, optional
+    the characters that start a comment line
+
+  Returns
+  -------
+  numpy array
+    the parsed column
+  """
+  if os.path.getsize(filename) > MMAP_SIZE :
+    try :
+      import pandas as pd
+    except ImportError :
+      pd = None
+    if pd is not None :
+      # pandas only takes a single comment character, so skip the header explicitly
+      nheader = 0
+      with open(filename,"r") as f :
+        for line in f :
+          if line[0] not in comments : break
+          nheader += 1
+      try :
+        data = pd.read_csv(filename,sep=r"\s+",header=None,skiprows=nheader,comment=comments[0],
+                           usecols=[colidx],dtype=np.float64,memory_map=True,engine="c").to_numpy().ravel()
+        return data[~np.isnan(data)]
+      except (ValueError,pd.errors.ParserError) :
+        pass
+
+  try :
+    return np.loadtxt(filename,comments=comments,usecols=(colidx,),dtype=np.float64,ndmin=1)
+  except (ValueError,IndexError) :
+    pass
+
+  # Malformed rows, fall back to streaming the file line-by-line
+  data = []
+  with open(filename,"r") as f :
+    for line in f :
+      if line[0] in comments : continue
+      try :
+        data.append(float(line.split()[colidx]))
+      except (ValueError,IndexError) :
+        pass
+  return np.array(data,dtype=np.float64)
+
 class _ResultsFile :
   """
   Parent class to encapsulate a results file from an umbrella/zconst
@@ -145,20 +362,24 @@ class _ResultsFile :
     self.samples = None
     self.center = center
     self.weight = weight
+    self._rng = None
     if filename is not None : self.read(filename,**kwargs)
   def __add__(self,other) :
     """ Adds the samples of another simulation onto this one
     """
     both = _ResultsFile(self.center,self.weight)
-    both.samples = np.zeros(self.samples.shape[0]+other.samples.shape[0])
-    both.samples[:self.samples.shape[0]] = self.samples
-    both.samples[self.samples.shape[0]:] = other.samples
+    both.samples = np.concatenate([self.samples,other.samples])
     return both
   def __radd__(self,other) :
+    """ Adds the samples of this simulation onto another one,
+    the 0 that sum() starts from gives a copy of this simulation
+    """
+    if np.isscalar(other) and other == 0 :
+      both = _ResultsFile(self.center,self.weight)
+      both.samples = self.samples.copy()
+      return both
     both = _ResultsFile(other.center,other.weight)
-    both.samples = np.zeros(self.samples.shape[0]+other.samples.shape[0])
-    both.samples[:self.other.shape[0]] = other.samples
-    both.samples[self.other.shape[0]:] = self.samples
+    both.samples = np.concatenate([other.samples,self.samples])
     return both
   def read(self,filename,**kwargs) :
     """ Should be implemented by sub-classes
@@ -178,7 +399,7 @@ class _ResultsFile :
     """
     if self.samples is None or (ispart and nskip < 2): return
     if ispart : nskip = int(np.floor(float(self.samples.shape[0])/float(nskip)))
-    self.samples = self.samples[nskip+1:]
+    self.samples = self.samples[nskip:]
   def shorten(self,n,ispart=True) :
     """
     Removes samples at the end of the simulation
@@ -193,7 +414,7 @@ class _ResultsFile :
     """
     if self.samples is None or (ispart and n < 2): return
     if ispart : n = int(np.floor(float(self.samples.shape[0])/float(n)))
-    self.samples = self.samples[:n+1]
+    self.samples = self.samples[:n]
   def block_it(self,nblocks) :
     """
     Sub-sample/block the samples
@@ -214,17 +435,26 @@ class _ResultsFile :
     blocklen = int(np.floor(float(nitems)/float(nblocks)))
     for i in range(nblocks) :
       blocks.append(_ResultsFile(self.center,self.weight))
-      blocks[-1].samples = self.samples[blocklen*i:min(blocklen*(i+1),nitems)]
+      # Copy so that the blocks do not keep the full trajectory alive
+      blocks[-1].samples = self.samples[blocklen*i:min(blocklen*(i+1),nitems)].copy()
     return blocks
-  def synthesize(self) :
+  def synthesize(self,rng=None) :
     """
     Replaces the samples with normal distributed data
     according to the mean and standard deviation of the orignal data
+
+    Parameters
+    ----------
+    rng : int or numpy Generator, optional
+      the seed or the random generator to use, pass the same Generator
+      to several results files to make a synthetic run reproducible
     """
+    if rng is not None : self._rng = np.random.default_rng(rng)
+    elif self._rng is None : self._rng = np.random.default_rng()
     self._samples_orig = self.samples
     mean = self.samples.mean()
     std  = self.samples.std()
-    self.samples = random.randn(self.samples.shape[0])*std + mean
+    self.samples = self._rng.normal(mean,std,size=self.samples.shape[0])
   def lower(self) :
     """
     Returns the lower part of the 99% confidence interval
@@ -252,7 +482,6 @@ class GromacsResultsFile(_ResultsFile) :
       colidx : the column index to parse
       isforces : if it is a pullf file rather than a pullx file
     """
-    data = []
     if "colidx" in kwargs :
       colidx = kwargs["colidx"]
     else :
@@ -261,20 +490,16 @@ class GromacsResultsFile(_ResultsFile) :
     if "isforces" in kwargs and kwargs["isforces"] :
       colidx = colidx - 1
 
-    for line in open(filename,'r').readlines() :
-      if not line[0] == "#" and not line[0] == "@" and len(line) > 4 :
-        try :
-          data.append(line.strip().split()[colidx])
-        except :
-          pass
+    data = _parse_column(filename,colidx,comments=("#","@"))
 
     if "isforces" in kwargs and kwargs["isforces"] :
-      self.samples =  np.array(data,dtype=float) / 10.0 * ECONV[KJMOL][KCALMOL] # Convert to kcal/mol/A
+      data *= ECONV[KJMOL][KCALMOL] / 10.0 # Convert to kcal/mol/A
     else :
-      self.samples = np.array(data,dtype=float)*10 # Convert to A
+      data *= 10.0 # Convert to A
       if colidx != 2 :
-        self.samples = -self.samples
-      if self.center > 0 : self.samples = np.abs(self.samples)
+        np.negative(data,out=data)
+      if self.center > 0 : np.abs(data,out=data)
+    self.samples = data
 
 class PlumedResultsFile(_ResultsFile) :
   """
@@ -292,24 +517,17 @@ class PlumedResultsFile(_ResultsFile) :
       colidx : the column index to parse
     """
 
-    data = []
-
     if "colidx" in kwargs :
       colidx = kwargs["colidx"]-1 # To make it compatible with Gromacs umbrella output
     else :
       colidx = 1
 
-    nread = 0
-    with open(filename,"r") as f :
-      line = f.readline()
-      while line :
-        if line[0] != "#" :
-          data.append(line.strip().split()[colidx])
-        line = f.readline()
-    self.samples = np.array(data,dtype=float)*10 # Convert to A
+    data = _parse_column(filename,colidx)
+    data *= 10.0 # Convert to A
     if colidx != 1 :
-      self.samples = -self.samples
-    if self.center > 0 and "expansion" not in kwargs : self.samples = np.abs(self.samples)
+      np.negative(data,out=data)
+    if self.center > 0 and "expansion" not in kwargs : np.abs(data,out=data)
+    self.samples = data
 
 class LammpsResultsFile(_ResultsFile) :
   """
@@ -331,18 +549,9 @@ class LammpsResultsFile(_ResultsFile) :
     else :
       stride = -1
 
-    data = []
-    nread = 0
-    with open(filename,"r") as f :
-      line = f.readline()
-      while line :
-        if line[0] != "#" :
-          nread = nread + 1
-          if stride <= 0 or (stride > 0 and (nread == 1 or (nread-1) % stride == 0)) :
-            if len(line.strip().split()) > 1 :
-              data.append(line.strip().split()[1])
-        line = f.readline()
-    self.samples = np.array(data,dtype=float)
+    data = _parse_column(filename,1)
+    if stride > 0 : data = data[::stride]
+    self.samples = data
 
 class SimpleEnergyFile(_ResultsFile) :
   """
@@ -360,14 +569,7 @@ class SimpleEnergyFile(_ResultsFile) :
     **kwargs :
       ignored at the moment
     """
-    data = []
-    with open(filename,"r") as f :
-      line = f.readline()
-      while line :
-        if line[0] != "#" :
-          data.append(line.strip().split()[1])
-        line = f.readline()
-    self.samples = np.array(data,dtype=float)
+    self.samples = _parse_column(filename,1)
 
 class UmbrellaSimulations() :
   """
@@ -393,8 +595,8 @@ class UmbrellaSimulations() :
     the samples of the simulations
   energies : list of numpy array
     the total energies of the simulation
-  histograms : list of numpy array
-    the histograms of the samples
+  histograms : numpy array
+    the histograms of the samples, one row per simulation
   bins : numpy array
     the bin edges of the histogram
   """
@@ -423,7 +625,7 @@ class UmbrellaSimulations() :
     self.samples.append(results.samples)
     self.centers.append(results.center)
     self.weights.append(results.weight)
-    if energies != None : self.energies.append(energies)
+    if energies is not None : self.energies.append(energies)
   def make_histograms(self,nbins,boundaries=None,weighted=True) :
     """
     Histogram the data
@@ -433,16 +635,16 @@ class UmbrellaSimulations() :
 
     Parameters
     ----------
-    nbins : int
-      the number of bins
+    nbins : int or numpy array
+      the number of bins or the edges of the histogram
     boundaries : list of float, optional
       the maximum and minimum values of the edges
     weighted : bool, optional
       whether to use to total energies to weight the histogram
     """
     if len(self.energies) == len(self.samples) and weighted :
-      weights = [np.exp(-e/self.kT) for e in self.energies]
-      self.histograms,self.bins = make_reweighted_histograms(self.samples,weights,nbins,boundaries)
+      self.bins = nbins if np.iterable(nbins) else make_bins(self.samples,nbins,boundaries)
+      self.histograms = _boltzmann_hist(self.samples,self.energies,self.kT,self.bins)
     else :
       self.histograms,self.bins = make_histograms(self.samples,nbins,boundaries)
   def make_bins(self,nbins,boundaries=None) :
@@ -471,14 +673,9 @@ class UmbrellaSimulations() :
     """
     if self.histograms is None : return
 
-    overlap = np.zeros(len(self.histograms)-1)
-    pairwise_o = [np.sqrt(h1*h2) for h1,h2 in zip(self.histograms[:-1],self.histograms[1:])]
-    pairwise_n    = [np.sqrt(s1.shape[0]*s2.shape[0]) for s1,s2 in zip(self.samples[:-1],self.samples[1:])]
-
-    for i,(o,n) in enumerate(zip(pairwise_o,pairwise_n)) :
-      overlap[i] = np.sum(o)/float(n)*100
-
-    return overlap
+    h = self.histograms
+    ns = np.fromiter((s.shape[0] for s in self.samples),dtype=np.float64,count=len(self.samples))
+    return np.sum(np.sqrt(h[:-1]*h[1:]),axis=1)/np.sqrt(ns[:-1]*ns[1:])*100
   def plot_histograms(self,xlabel="z-distance",filename=None) :
     """
     Plot all histograms
@@ -499,6 +696,7 @@ class UmbrellaSimulations() :
     """
     if self.histograms is None or self.bins is None : return None
 
+    import matplotlib.pyplot as plt
     hfig = plt.figure()
     z = (self.bins[:-1]+self.bins[1:])/2.0
     for s,h in zip(self.samples,self.histograms) :
@@ -539,10 +737,17 @@ class UmbrellaSimulations() :
 #        prob0[i] = prob0[i]+num/norm
 #    free = -self.kT*np.log(prob0)
 #    free = free - free[0]
-#    print self.whamobj.free-self.whamobj.free[0]
+#    print(self.whamobj.free-self.whamobj.free[0])
 #    return free
 
 
+def _pmf_one(simulations,genclass,kwargs) :
+  """
+  Compute the PMF of a single set of simulations, defined at module level
+  so that it can be pickled and sent to worker processes
+  """
+  return genclass(simulations).pmf(**kwargs)
+
 class UmbrellaPmf :
   """
   Class to encapsulate an average PMF from umbrella simulations
@@ -554,8 +759,8 @@ class UmbrellaPmf :
   z : numpy array
     the values of the reaction coordinate, it is assumed that all simulation sets
     have been histogrammed with the same edges
-  pmfs : list of numpy array
-    the pmfs of each UmbrellaSimultions object
+  pmfs : numpy array
+    the pmfs of each UmbrellaSimultions object, one column per object
   av : numpy array
     the average pmf
   std : numpy array
@@ -592,19 +797,41 @@ class UmbrellaPmf :
     self.std = self.std * ECONV[self.unit][unit]
     self.kT = self.simulations[0].temperature*KB[unit]
     self.unit = unit
-  def make(self,simulations,genclass,**kwargs) :
+  def make(self,simulations,genclass,n_jobs=1,**kwargs) :
+    """
+    Compute the PMF of each set of simulations and average them
+
+    Parameters
+    ----------
+    simulations : list of UmbrellaSimulations
+      the simulation sets, e.g. blocks of the full simulations
+    genclass : class
+      the _PmfGenerator sub-class used to compute each PMF
+    n_jobs : int, optional
+      the number of processes used to compute the PMFs in parallel,
+      -1 uses all cores. Requires joblib if not 1. Keep at 1 for
+      ExternalWham, which already runs an external program per PMF
+    **kwargs :
+      passed on to the pmf method of genclass
+    """
     self.simulations = simulations
-    pmfs_and_z = [genclass(sim).pmf(**kwargs) for sim in simulations]
+    if n_jobs != 1 :
+      import joblib
+      pmfs_and_z = joblib.Parallel(n_jobs=n_jobs,backend="loky")(joblib.delayed(_pmf_one)(sim,genclass,kwargs) for sim in simulations)
+    else :
+      pmfs_and_z = [_pmf_one(sim,genclass,kwargs) for sim in simulations]
     self.z = pmfs_and_z[0][0]
-    self.pmfs = [pz[1] for pz in pmfs_and_z]
-    self.pmfs = np.array(self.pmfs).transpose()
+    # Column-major, so that each PMF is a contiguous column
+    pmfs = np.empty((self.z.shape[0],len(pmfs_and_z)),order="F")
+    for j,(_,p) in enumerate(pmfs_and_z) :
+      pmfs[:,j] = p
 
     # Remove undefined z-values a set zero-pint
-    idx = np.all(np.isfinite(self.pmfs),axis=1)
+    idx = np.all(np.isfinite(pmfs),axis=1)
     self.z = self.z[idx]
-    self.pmfs = self.pmfs[idx,:]
+    self.pmfs = np.asfortranarray(pmfs[idx,:])
     if not "no_offset" in kwargs :
-      self.pmfs = self.pmfs - self.pmfs[-1,:]
+      self.pmfs -= self.pmfs[-1,:].copy()
 
     self.unit = simulations[0].unit
     self.kT = simulations[0].kT
@@ -670,6 +897,7 @@ class UmbrellaPmf :
       the figure created
     """
     if fig is None :
+      import matplotlib.pyplot as plt
       fig = plt.figure()
     if color is None :
       fig.gca().errorbar(self.z[::stride],self.av[::stride],yerr=self.std[::stride],label=label)
@@ -704,18 +932,11 @@ class UmbrellaPmf :
     return self.av[0]-self.av[i],np.sqrt(self.std[0]**2+self.std[i]**2)
   def _trapz(self,x,av,stds) :
     # Trapezoid integration with error propagation
-    intsum = 0.0
-    w = 0.5*(x[0]+x[1])
-    std = w**2*stds[0]**2
-    for i in range(1,len(x)) :
-      h = x[i]-x[i-1]
-      intsum = intsum + h*(av[i]+av[i-1])/2.0
-      if i == len(x) - 1 :
-        w = 1.0 - 0.5*(x[i]+x[i-1])
-      else :
-        w = 0.5*(x[i+1]-x[i-1])
-      std = std + w**2*stds[i]**2
-    return intsum,np.sqrt(std)
+    w = np.empty_like(x)
+    w[0] = 0.5*(x[0]+x[1])
+    w[1:-1] = 0.5*(x[2:]-x[:-2])
+    w[-1] = 1.0 - 0.5*(x[-1]+x[-2])
+    return _trapezoid(av,x),np.sqrt(np.sum((w*stds)**2))
 
   def standard_dg(self) :
     """
@@ -723,12 +944,16 @@ class UmbrellaPmf :
     """
     # JCTC, 2011, 7, 4175-4188
 
-    expav = np.exp(-self.av/self.kT)
-    expstd = np.abs(expav*(-self.std/self.kT))
+    kT = self.kT
+    inv_kT = 1.0/kT
+    expav = np.exp(self.av*-inv_kT)
+    expstd = np.multiply(expav,self.std)
+    expstd *= inv_kT
+    np.abs(expstd,out=expstd)
     bndint,bndstd = self._trapz(self.z,expav,expstd)
-    freeint = np.trapz(np.ones(self.z.shape[0]),self.z)
-    bind = -self.kT * np.log(bndint/freeint)
-    uncert = np.abs(-self.kT*bndstd/bndint)
+    freeint = self.z[-1]-self.z[0]
+    bind = -kT * np.log(bndint/freeint)
+    uncert = np.abs(kT*bndstd/bndint)
     return bind,uncert
 
   def partition(self,water_density) :
@@ -740,8 +965,12 @@ class UmbrellaPmf :
     f = interp1d(water_density[:,0],water_density[:,1],kind="cubic")
     rho = f(self.z)
     rho = rho/rho.max()
-    expav = np.exp(-self.av/self.kT) - rho
-    expstd = np.abs(expav*(-self.std/self.kT))
+    inv_kT = 1.0/self.kT
+    expav = np.exp(self.av*-inv_kT)
+    expav -= rho
+    expstd = np.multiply(expav,self.std)
+    expstd *= inv_kT
+    np.abs(expstd,out=expstd)
     bndint,bndstd = self._trapz(self.z,expav,expstd)
     if bndint < 0 :
       expstd[expstd<0] = 0
@@ -759,6 +988,28 @@ class UmbrellaPmf :
 # Classes that implements the WHAM
 ###################################
 
+def _autocorrelation(x) :
+  """
+  Normalized autocorrelation function of a centered series
+
+  Computed by real FFT, zero-padded to avoid circular wrap-around
+
+  Parameters
+  ----------
+  x : numpy array
+    the series, should have zero mean
+
+  Returns
+  -------
+  numpy array
+    the autocorrelation for lags 0 to len(x)-1
+  """
+  n = 1 << (2*x.shape[0]-1).bit_length()
+  f = np.fft.rfft(x,n)
+  acf = np.fft.irfft(f*np.conjugate(f),n)[:x.shape[0]]
+  acf /= acf[0]
+  return acf
+
 class _PmfGenerator(object) :
   """
   Class to encapsulate any algorithm to compute a PMF from
@@ -815,10 +1066,7 @@ class Diffusion(_PmfGenerator) :
       diff[i] = s.var()/self._tau(s,dt)
     return self.centers,diff
   def _tau(self,z,dt) :
-    dz = z-z.mean()
-    acf = np.correlate(dz,dz,mode="full")
-    acf = acf[len(acf)//2:]
-    acf /= acf[0]
+    acf = _autocorrelation(z-z.mean())
     import scipy.optimize as opt
     def double_exp(x,a0,a1,t0,t1) :
       return a0*np.exp(-x/t0)+a1*np.exp(-x/t1)
@@ -831,7 +1079,7 @@ class Diffusion(_PmfGenerator) :
     except :
       popt,pcov = opt.curve_fit(single_exp,x,acf,p0=[10,0.1])
       acf_opt = single_exp(x,*popt)
-    t = np.trapz(acf_opt)*dt
+    t = _trapezoid(acf_opt)*dt
     return np.abs(t)
 
 class ZConst(_PmfGenerator) :
@@ -874,23 +1122,16 @@ class ZConst(_PmfGenerator) :
       resistance = np.divide(np.exp(self._pmf/self.kT),self._diffusion)
       return self.centers,resistance
   def compute_pmf(self) :
-    avf = [s.mean() for s in self.samples]
-    print len(self.samples)
-    print avf,self.samples[0][0]
-    print self.centers
-    avf = np.array(avf[::-1])
-    zrev = self.centers[::-1]
-    pmf = np.zeros(avf.shape)
-    for i,av in enumerate(avf) :
-      pmf[i] = np.trapz(avf[:i+1],zrev[:i+1])
-      print zrev[:i+1],pmf[i]
+    from scipy.integrate import cumulative_trapezoid
+    avf = np.fromiter((s.mean() for s in self.samples),dtype=np.float64,count=len(self.samples))
+    logger.debug("windows=%d centers=%s",len(self.samples),self.centers)
+    # Integrate the mean force from the last window
+    pmf = cumulative_trapezoid(avf[::-1],self.centers[::-1],initial=0.0)
     self._pmf = pmf[::-1]
   def compute_diffusion(self) :
     self._diffusion = self.kT*self.kT*np.ones(self.centers.shape)
     for i,s in enumerate(self.samples) :
-      df = s-s.mean()
-      x = np.fft.fft(df)
-      acf = np.real(np.fft.ifft(s*np.conjugate(s)))
+      acf = _autocorrelation(s-s.mean())
 
 class Wham(_PmfGenerator) :
   """
@@ -898,8 +1139,8 @@ class Wham(_PmfGenerator) :
 
   Attributes
   ----------
-  histograms : list of numpy array
-    the histograms of the samples
+  histograms : numpy array
+    the histograms of the samples, one row per window
   bins : numpy array
     the bin edges of the histogram
   F : numpy array
@@ -956,8 +1197,8 @@ class Wham(_PmfGenerator) :
 class ExternalWham(Wham) :
   """
   Converge the bias free energies until self-consistency
-  do this by calling an external program which is faster
-  than the pure Python implementation
+  do this by calling an external program
+  rather than with PyWham
 
   Uses the wham program from the Grossfield lab
 
@@ -980,12 +1221,10 @@ class ExternalWham(Wham) :
     freefile = "%s/wham_free"%tempfolder
     logfile  = "%s/wham_log"%tempfolder
 
-    #whamcommand = "%s %.4f %.4f %d %.0E %.2f 0 %s %s >& %s"%(whamprog,self.bins[0],self.bins[-1],self.bins.shape[0]-1,tolerance,self.temperature,metafile,freefile,logfile)
-    #subprocess.call(whamcommand,shell=True)
-
-    whamcommand = "%s %.4f %.4f %d %.0E %.2f 0 %s %s"%(whamprog,self.bins[0],self.bins[-1],self.bins.shape[0]-1,tolerance,self.temperature,metafile,freefile)
-    with open(logfile, "w") as f:
-        subprocess.call(whamcommand,shell=True, stdout=f, stderr=f)
+    whamargs = [whamprog,"%.4f"%self.bins[0],"%.4f"%self.bins[-1],"%d"%(self.bins.shape[0]-1),
+                "%.0E"%tolerance,"%.2f"%self.temperature,"0",metafile,freefile]
+    with open(logfile,"w") as f :
+      subprocess.run(whamargs,stdout=f,stderr=subprocess.STDOUT,check=True)
 
     self._extract_output(freefile)
 
@@ -994,12 +1233,11 @@ class ExternalWham(Wham) :
   def _write_datafiles(self,tempfolder) :
     """ Write out all data to files in the tempfolder
     """
+    fmt = "%d %.8f" + (" %.8f" if self._hasenergies else "")
     for i,sample in enumerate(self.samples) :
-      with open("%s/traj%d"%(tempfolder,i),"w") as f :
-        for j,coor in enumerate(sample) :
-          f.write("%d %.8f"%(j+1,coor))
-          if self._hasenergies : f.write(" %.8f"%(self.energies[i][j]))
-          f.write("\n")
+      cols = [np.arange(1,sample.shape[0]+1),sample]
+      if self._hasenergies : cols.append(self.energies[i][:sample.shape[0]])
+      np.savetxt("%s/traj%d"%(tempfolder,i),np.column_stack(cols),fmt=fmt)
   def _write_metafile(self,tempfolder) :
     """ Write out a WHAM metadata file
     """
@@ -1013,100 +1251,191 @@ class ExternalWham(Wham) :
   def _extract_output(self,filename) :
     """ Extract results from WHAM
     """
-    self.F = np.zeros(len(self.samples))
-    self.prob = np.zeros(self.bins.shape[0]-1)
-    self.free = np.zeros(self.bins.shape[0]-1)
+    nbins = self.bins.shape[0]-1
+    nwindows = len(self.samples)
     with open(filename,"r") as f :
-      line = f.readline()
-      # Look for the coordinates and extract the probability of each coordinate
-      for i in range(self.bins.shape[0]-1) :
-        cols = f.readline().strip().split()
-        self.prob[i] = float(cols[3])
-        self.free[i] = float(cols[1])
-      # Look for the window free energies and extract them
-      line = f.readline()
-      for i in range(self.F.shape[0]) :
-        cols = f.readline().strip().split()
-        self.F[i] = float(cols[1])
+      lines = f.readlines()
+    # After a header line, the free energy and probability of each coordinate
+    data = np.loadtxt(lines[1:nbins+1],usecols=(1,3),ndmin=2)
+    self.free = data[:,0].copy()
+    self.prob = data[:,1].copy()
+    # After another header line, the window free energies,
+    # these lines start with # so comments are not stripped
+    self.F = np.loadtxt(lines[nbins+2:nbins+2+nwindows],usecols=(1,),comments=None,ndmin=1)
+
+def _wham_oneiter_impl(biasOverKT,Fold,nsamples,histsum,kT,prob,logp,F) :
+  """
+  One WHAM iteration fused into loops over the bias matrix,
+  writes the unnormalized probability distribution, its logarithm
+  and the new bias free energies into prob, logp and F
+
+  The probability of each bin is independent of the other bins, and
+  the sum over bins for each window is independent of the other windows,
+  so both loops are parallel without any shared accumulator
+  """
+  nbins,nwindows = biasOverKT.shape
+  FoldOverKT = Fold*(1.0/kT)
+  for i in prange(nbins) :
+    denom = 0.0
+    for w in range(nwindows) :
+      denom += math.exp(FoldOverKT[w]-biasOverKT[i,w])*nsamples[w]
+    prob[i] = histsum[i]/denom
+    if prob[i] > 0.0 : logp[i] = math.log(prob[i])
+  for w in prange(nwindows) :
+    # Log-sum-exp over the populated bins, shifted by the largest term
+    # for numerical stability
+    m = 0.0
+    found = False
+    for i in range(nbins) :
+      if prob[i] > 0.0 :
+        x = logp[i]-biasOverKT[i,w]
+        if not found or x > m :
+          m = x
+          found = True
+    Fsum = 0.0
+    for i in range(nbins) :
+      if prob[i] > 0.0 :
+        Fsum += math.exp(logp[i]-biasOverKT[i,w]-m)
+    F[w] = -kT*(m+math.log(Fsum))
+  Flast = F[nwindows-1]
+  for w in range(nwindows) :
+    F[w] -= Flast
+
+# The types the kernel is compiled for, double and single precision working arrays
+WHAM_ONEITER_SIGNATURES = {
+  "f8" : "void(f8[:,:],f8[:],f8[:],f8[:],f8,f8[:],f8[:],f8[:])",
+  "f4" : "void(f4[:,:],f4[:],f4[:],f4[:],f8,f4[:],f4[:],f4[:])"}
+
+# The compiled kernels by signature, created on first use so that
+# importing the module does not compile them
+_wham_oneiter_kernels = {}
+
+def _wham_oneiter_kernel(dtype) :
+  """
+  Returns the compiled WHAM iteration kernel for working arrays of dtype
+
+  The kernel is jitted by numba, which runs it in parallel. If numba is not
+  available, the serial kernel of the wham_ext module built by build_wham_ext.py
+  is used instead. Returns None if neither is available
+  """
+  sig = "f4" if np.dtype(dtype) == np.float32 else "f8"
+  if sig not in _wham_oneiter_kernels :
+    kernel = None
+    if HAS_NUMBA :
+      kernel = njit(WHAM_ONEITER_SIGNATURES[sig],parallel=True,fastmath=True,cache=True)(_wham_oneiter_impl)
+    else :
+      try :
+        import wham_ext
+        kernel = wham_ext.oneiter_f4 if sig == "f4" else wham_ext.oneiter
+      except ImportError :
+        pass
+    _wham_oneiter_kernels[sig] = kernel
+  return _wham_oneiter_kernels[sig]
 
 class PyWham(Wham) :
   """
-  Pure Python implementation of the WHAM algorithm,
-  relatively slow but reproduces the wham program from the Grossfield lab
+  Python implementation of the WHAM algorithm,
+  reproduces the wham program from the Grossfield lab
+
+  Each iteration runs in a compiled numba kernel, parallel over
+  bins and windows, if numba is available, otherwise in the kernel
+  built by build_wham_ext.py if it is importable, or else with NumPy
+  vectorized over bins and windows
+
+  Attributes
+  ----------
+  dtype : numpy dtype
+    the floating point type of the working arrays, np.float32 halves the
+    memory traffic but the tolerance should then be well above its resolution,
+    the final free energy is always computed in double precision
   """
+  def __init__(self,simulations,dtype=np.float64) :
+    super(PyWham,self).__init__(simulations)
+    self.dtype = dtype
   def iterate(self,tolerance=1E-5,maxiter=100000,verbose=True) :
     if self.histograms is None : return
-    self.nwindows = len(self.histograms) # Store number of windows for convenience
-    self.nsamples = [h.sum() for h in self.histograms] # The number of samples used to build the different histograms
+    self.histograms = np.ascontiguousarray(np.vstack(self.histograms),dtype=self.dtype) # One row per window
+    self.nwindows = self.histograms.shape[0] # Store number of windows for convenience
+    self.nsamples = self.histograms.sum(axis=1) # The number of samples used to build the different histograms
+    self._histsum = self.histograms.sum(axis=0) # The number of samples in each bin, over all windows
     self.nbins = self.bins.shape[0]-1
-    self.bins = (self.bins[1:]+self.bins[:-1])/2.0
-
-    self.F = np.zeros(self.nwindows)#+self.addbias-self.addbias[0]
-    self.__Fold = np.zeros(self.nwindows)
-    self.prob = np.zeros(self.nbins)
+    zbins = (self.bins[1:]+self.bins[:-1])/2.0
+    # The harmonic bias of every window at every bin, rows are bins and columns windows,
+    # it does not change between iterations
+    self._bias = np.subtract(self.centers,zbins[:,np.newaxis]).astype(self.dtype)
+    self._bias *= self._bias
+    self._bias *= 0.5*self.weights
+    self._invKT = 1.0/self.kT
+    self._biasOverKT = self._bias*self._invKT
+
+    self.F = np.zeros(self.nwindows,dtype=self.dtype)#+self.addbias-self.addbias[0]
+    self.__Fold = np.zeros(self.nwindows,dtype=self.dtype)
+    self.prob = np.zeros(self.nbins,dtype=self.dtype)
+    self._logp = np.full(self.nbins,-np.inf,dtype=self.dtype)
+    self._diff = np.zeros(self.nwindows,dtype=self.dtype)
+    self._err = 0.0
+    self._kernel = _wham_oneiter_kernel(self.dtype)
     self.niter = 0
+    # The same arrays are updated in-place by every iteration
     while self.niter == 0 or not self.__converged(tolerance) :
       self.niter +=1
-      if verbose and self.niter % 1 == 0 :
-        print "Maximum error at iteration %d is %10E"%(self.niter,self.__maxerr())
-        print "\t F: %s"%", ".join(["%.5f"%f for f in self.F])
-      self.__Fold = np.array(self.F,copy=True)
-      self.F = np.zeros(self.nwindows)
+      if verbose and self.niter % 100 == 0 :
+        print("Maximum error at iteration %d is %10E"%(self.niter,self._err))
+        print("\t F: %s"%", ".join(["%.5f"%f for f in self.F]))
+      np.copyto(self.__Fold,self.F)
       self.__oneiter()
       if self.niter == maxiter :
-        print "Maximum number iterations reached without finding a solution!"
+        print("Maximum number iterations reached without finding a solution!")
         break
     # Normalize the probabilities
+    self.prob = self.prob.astype(np.float64)
     self.prob = self.prob / self.prob.sum()
     # Calculate the free energy and normalize with respect to 0
     self.free = -self.kT*np.log(self.prob)
     self.free = self.free - self.free[0]
-  def __calc_bias(self,coor) :
-    """ Calculate harmonic bias potential
-    """
-    dx = self.centers - coor
-    harmonic = 0.5*self.weights*dx*dx
-    return  harmonic
   def __converged(self,tolerance) :
     """ Check if the free energies are converged
     """
-    error = np.abs(self.F-self.__Fold)
-    return error.max() <= tolerance
+    return self.__maxerr() <= tolerance
   def __maxerr(self) :
-    """ Calculate the maximum error
+    """ Calculate the maximum error and store it in self._err
     """
-    error = np.abs(self.F-self.__Fold)
-    return error.max()
+    np.subtract(self.F,self.__Fold,out=self._diff)
+    np.abs(self._diff,out=self._diff)
+    self._err = self._diff.max()
+    return self._err
   def __oneiter(self) :
     """ Perform one Wham iteration
     """
-    # Loop over all edges of the histograms
-    for i,coor in enumerate(self.bins) :
-      # Use the previously calculated bias free energies (self.F)
-      # to estimate the probability distribution
-      num = 0.0
-      denom = np.exp((self.__Fold-self.__calc_bias(coor))/self.kT)*self.nsamples
-      for hi,histo in enumerate(self.histograms) :
-        num = num + histo[i]
-      self.prob[i] = num / denom.sum()
-      # Update the bias free energies using the estimated probability distribution
-      self.F = self.F + np.exp(-self.__calc_bias(coor)/self.kT)*self.prob[i]
-    # Take the logarithm and remove an arbitrary constant
-    self.F = -self.kT*np.log(self.F)
-    self.F = self.F-self.F[-1]
+    if self._kernel is not None :
+      self._kernel(self._biasOverKT,self.__Fold,self.nsamples,self._histsum,self.kT,self.prob,self._logp,self.F)
+      return
+    from scipy.special import logsumexp
+    # Use the previously calculated bias free energies (self.__Fold)
+    # to estimate the probability distribution, the sum over windows
+    # weighted by the number of samples is a matrix-vector product
+    expF = np.exp(self.__Fold*self._invKT-self._biasOverKT)
+    np.divide(self._histsum,expF @ self.nsamples,out=self.prob)
+    # Update the bias free energies using the estimated probability distribution,
+    # summing exp(log(prob)-bias/kT) as a log-sum-exp for numerical stability,
+    # empty bins always have zero probability and keep log(0) = -inf
+    np.log(self.prob,out=self._logp,where=self.prob>0)
+    self.F[:] = logsumexp(self._logp[:,np.newaxis]-self._biasOverKT,axis=0)
+    # Remove an arbitrary constant
+    self.F *= -self.kT
+    self.F -= self.F[-1]
 
 
 # For debugging
 if __name__ == '__main__' :
 
   import sys
+  import matplotlib.pyplot as plt
   results = GromacsResultsFile(1.0,0.0,filename=sys.argv[1],isforces=True)
   results.skip(3)
   s = results.samples
-  df = s-s.mean()
-  x = np.fft.fft(df)
-  acf = np.real(np.fft.ifft(s*np.conjugate(s)))/s.var()
-  print s.shape,acf.shape,acf[0]
+  acf = _autocorrelation(s-s.mean())
+  print("%s %s %f"%(s.shape,acf.shape,acf[0]))
   f = plt.figure()
   a = f.add_subplot(311)
   a.plot(s)
@@ -1118,11 +1447,11 @@ if __name__ == '__main__' :
       return A*np.exp(-x/tau0)+B*np.exp(-x/tau1)
   from scipy.optimize import curve_fit
   popt,pcov = curve_fit(fopt,np.arange(acf.shape[0]),acf,[0.5,0.5,0.1,0.1])
-  print popt
+  print(popt)
   a = f.add_subplot(313)
   y = fopt(np.arange(acf.shape[0]),*popt)
-  print y[0]
+  print(y[0])
   a.plot(y[:10])
   a.plot(acf[:10])
   f.savefig("temp.png",format="png")
-  print (KB[KJMOL]*300)**2*np.trapz(y)
+  print((KB[KJMOL]*300)**2*_trapezoid(y))